@@ -7,8 +7,16 @@ Testen Sie zuerst mit DRY_RUN = True.
 """
 
 from fritzconnection import FritzConnection, FritzService
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from collections import deque
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
 import time
 import datetime
+import functools
+import os
 import sys
 
 # Konfiguration
@@ -18,48 +26,190 @@ PASSWORD = "yourpassword"
 THRESHOLD_SECONDS = 3600 * 24   # z.B. 24 Stunden
 DRY_RUN = True
 TIMEOUT = 10
+# TR-064-Beschreibungen der Box zwischenspeichern, damit Folgeläufe (z.B. per cron)
+# das XML nicht erneut laden und parsen müssen. Der Cache enthält nur die
+# Service-Beschreibungen, keine Verbindungsdaten – DRY_RUN ist davon unabhängig.
+# Nach einem Firmware-Update den Cache-Ordner löschen.
+USE_CACHE = True
+CACHE_DIRECTORY = os.path.expanduser("~/.cache/fritzconnection")
+CLOSE_WORKERS = 4               # parallele Close-Aufrufe (DRY_RUN = False)
+
+# Felder, die darauf hindeuten, dass ein dict eine Verbindung beschreibt
+HINT_KEYS = frozenset({"RemoteHost", "RemotePort", "Protocol", "BytesSent", "BytesReceived",
+                       "LastActivity", "LastActive", "ConnectionID", "Id", "ID", "State"})
+# Vorgefertigter SOAP-Umschlag für die Close-Actions (spart den DOM-Aufbau pro Call)
+SOAP_TMPL = ('<?xml version="1.0"?>'
+             '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+             's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+             '<s:Body><u:{action} xmlns:u="{svc_type}">{args}</u:{action}></s:Body></s:Envelope>')
+# Felder für den Zeitpunkt der letzten Aktivität, in Prioritätsreihenfolge
+TIME_FIELDS = ("LastActivity", "LastActive", "LastSeen", "Time", "Timestamp")
 
 def try_service(fc, service_type_fragments):
     """Versucht, einen Service anhand mehrerer Type-Fragmente zu finden."""
-    for frag in service_type_fragments:
-        try:
-            # Suche Service-Objekt durch seinem Namen (fritzconnection kann unterschiedliche Namen verwenden)
-            # Prüfen auf existierende Services
-            for svcname in fc.services:
-                if frag.lower() in svcname.lower():
-                    try:
-                        return FritzService(fc, svcname)
-                    except Exception:
-                        continue
-        except Exception:
-            continue
-    return None
+    # Ergebnis pro Fragment-Liste auf der Verbindung merken
+    cache = fc.__dict__.setdefault("_svc_cache", {})
+    cache_key = tuple(service_type_fragments)
+    if cache_key in cache:
+        return cache[cache_key]
+    # Service-Namen und Fragmente nur einmal in Kleinbuchstaben umwandeln
+    svc_lc = [(n, n.lower()) for n in fc.services]
+    frags_lc = [f.lower() for f in service_type_fragments]
+    svc = None
+    for frag in frags_lc:
+        for svcname, svcname_lc in svc_lc:
+            if frag in svcname_lc:
+                try:
+                    svc = FritzService(fc, svcname)
+                    break
+                except Exception:
+                    continue
+        if svc is not None:
+            break
+    cache[cache_key] = svc
+    return svc
+
+def find_conn_nodes(obj):
+    """Sucht iterativ nach dicts mit Verbindungs-Feldern (siehe HINT_KEYS)."""
+    found = []
+    stack = deque([obj])
+    while stack:
+        x = stack.pop()
+        if isinstance(x, dict):
+            if not HINT_KEYS.isdisjoint(x):
+                found.append(x)
+            else:
+                stack.extend(reversed(list(x.values())))
+        elif isinstance(x, list):
+            stack.extend(reversed(x))
+    return found
 
 def parse_time_str(s):
     """Versuche verschiedene Zeitformate zu parsen, Rückgabe Unix-Timestamp oder None."""
     if s is None:
         return None
-    # Wenn bereits int-string
+    if isinstance(s, str):
+        return _parse_time_text(s)
+    # Zahlen direkt übernehmen; Listen/dicts o.ä. sind kein Zeitstempel
     try:
         return int(s)
-    except Exception:
+    except (TypeError, ValueError):
+        return None
+
+# Gleiche Zeitstempel wiederholen sich oft über viele Verbindungen hinweg
+@functools.lru_cache(maxsize=4096)
+def _parse_time_text(s):
+    """Parst einen Zeitstempel-String (gecacht), Rückgabe Unix-Timestamp oder None."""
+    s = s.strip()
+    # Wenn bereits int-string
+    # isdecimal statt isdigit: isdigit akzeptiert z.B. "²", das int() ablehnt
+    digits = s[1:] if s[:1] in ("+", "-") else s
+    if digits.isdecimal():
+        return int(s)
+    # ISO 8601 ("YYYY-MM-DDTHH:MM:SS" / "YYYY-MM-DD HH:MM:SS") ohne Exception-Kaskade
+    try:
+        return int(datetime.datetime.fromisoformat(s.replace("Z", "+00:00")).timestamp())
+    except ValueError:
         pass
-    fmts = ("%Y-%m-%dT%H:%M:%S", "%d.%m.%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S")
-    for f in fmts:
-        try:
-            dt = datetime.datetime.strptime(s, f)
-            return int(dt.timestamp())
-        except Exception:
+    try:
+        return int(datetime.datetime.strptime(s, "%d.%m.%Y %H:%M:%S").timestamp())
+    except ValueError:
+        return None
+
+def iter_stale_connections(connections):
+    """Liefert (Verbindung, Timestamp, Alter) für jede eindeutige Verbindung älter als THRESHOLD_SECONDS."""
+    seen = set()
+    # Bei höchstens einer Verbindung gibt es nichts zu deduplizieren
+    dedup = len(connections) > 1
+    now = time.time()
+    for c in connections:
+        if dedup:
+            # frozenset ist unabhängig von der Key-Reihenfolge, die je Action variieren kann,
+            # und kommt ohne Sortieren aus
+            key = frozenset((k, str(v)) for k, v in c.items())
+            if key in seen:
+                continue
+            seen.add(key)
+        # Falls kein Zeitstempel, evtl. Bytes-Transfer seit letzter Aktivität -> überspringen
+        ts = parse_time_str(next((c[f] for f in TIME_FIELDS if f in c), None))
+        if ts is None:
             continue
-    return None
+        age = now - ts
+        if age >= THRESHOLD_SECONDS:
+            yield c, ts, int(age)
+
+def conn_identifiers(c):
+    """Bestimmt (ConnectionID, RemoteHost, RemotePort) einer Verbindung zum Schließen."""
+    connid = c.get("ConnectionID") or c.get("Id") or c.get("ID")
+    remote = c.get("RemoteHost") or c.get("Description") or ""
+    port = c.get("RemotePort") or c.get("Port") or ""
+    return connid, remote, port
+
+def _fast_call(fc, svc, action, args):
+    """Sendet eine SOAP-Action direkt über fc.session (ohne fritzconnection-Envelope/Parser)."""
+    args_xml = "".join(f"<{k}>{escape(str(v))}</{k}>" for k, v in args.items())
+    body = SOAP_TMPL.format(action=action, svc_type=svc.service_type, args=args_xml)
+    headers = {
+        "Content-Type": 'text/xml; charset="utf-8"',
+        "SOAPACTION": f'"{svc.service_type}#{action}"',
+    }
+    # Adresse (inkl. http/https) und Port wie bei call_action aus der Verbindung übernehmen
+    url = f"{fc.soaper.address}:{fc.soaper.port}{svc.controlURL}"
+    # Auth kommt von fc.session, damit die Digest-Nonce über alle Calls erhalten bleibt
+    r = fc.session.post(url, data=body.encode("utf-8"), headers=headers, timeout=TIMEOUT)
+    # SOAP-Faults kommen mit HTTP 500; die Fehlerbeschreibung aus dem Body übernehmen
+    try:
+        root = ET.fromstring(r.content)
+    except ET.ParseError:
+        root = None
+    if root is not None:
+        fault = root.find(".//{http://schemas.xmlsoap.org/soap/envelope/}Fault")
+        if fault is not None:
+            desc = next((el.text for el in fault.iter() if el.tag.endswith("errorDescription")), None)
+            raise RuntimeError(f"SOAP-Fault bei {action}: {desc or fault.findtext('faultstring')}")
+    r.raise_for_status()
+
+def close_one(c, close_map, svc, fc):
+    """Versucht, eine Verbindung zu schließen. Rückgabe (ok, action, err)."""
+    connid, remote, port = conn_identifiers(c)
+    # Fallback ohne ID: RemoteHost/RemotePort falls benötigt
+    fallback_args = {}
+    if remote:
+        fallback_args["RemoteHost"] = remote
+    if port:
+        fallback_args["RemotePort"] = port
+    err = None
+    for action in close_map:
+        args = {close_map[action]: connid} if connid else fallback_args
+        try:
+            _fast_call(fc, svc, action, args)
+            return True, action, None
+        except Exception as e:
+            err = e
+            # Bei fehlender Berechtigung scheitern auch alle weiteren Actions
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status in (401, 403):
+                break
+            # sonst weiter versuchen
+    return False, None, err
 
 def main():
     try:
-        fc = FritzConnection(address=FRITZ_HOST, user=USERNAME, password=PASSWORD, timeout=TIMEOUT)
+        fc = FritzConnection(address=FRITZ_HOST, user=USERNAME, password=PASSWORD, timeout=TIMEOUT,
+                             use_cache=USE_CACHE, cache_directory=CACHE_DIRECTORY)
     except Exception as e:
         print("Verbindung zur FRITZ!Box fehlgeschlagen:", e)
         sys.exit(1)
 
+    # Größerer Connection-Pool, damit parallele SOAP-Calls (Probes, Close-Actions) nicht auf
+    # freie Verbindungen warten; gepoolte Verbindungen werden wiederverwendet
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=2)
+    fc.session.mount("http://", adapter)
+    fc.session.mount("https://", adapter)
+    # Eine gemeinsame Digest-Auth für die direkten Close-Calls (_fast_call)
+    if fc.session.auth is None:
+        fc.session.auth = HTTPDigestAuth(USERNAME, PASSWORD)
+
     # Mögliche Services, die Informationen zu Verbindungen liefern könnten
     candidates = [
         "WANIPConnection", "WANPPPConnection", "ConnectionManager",
@@ -75,152 +225,83 @@ def main():
 
     print("Verwendeter Service:", svc.service_type)
 
+    # svc.actions einmal abgreifen statt die Property wiederholt auszuwerten
+    close_actions = ["DeleteConnection", "CloseConnection", "ForceCloseConnection", "DestroyConnection"]
+    actions = dict(svc.actions)
+    action_meta = {a: actions[a] or {} for a in close_actions if a in actions}
+
     # Mögliche Actions, die aktive Verbindungen liefern können
     actions_to_try = [
         "GetActiveConnections", "GetGenericConnections", "GetConnectionList",
         "GetActivePortMappings", "GetPortMappingNumberOfEntries"
     ]
 
-    connections = []
-    for act in actions_to_try:
-        if act in svc.actions:
+    # Probes parallel absetzen: jede Action ist ein eigener SOAP-Roundtrip zur Box.
+    # Manche Services führen Actions nicht in svc.actions auf, daher alle versuchen;
+    # nicht implementierte Actions landen im except.
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(actions_to_try)) as ex:
+        futures = {ex.submit(svc.call_action, a): a for a in actions_to_try}
+        for fut in as_completed(futures):
             try:
-                res = svc.call_action(act)
+                results[futures[fut]] = fut.result()
             except Exception:
                 continue
-            # res kann verschiedene Strukturen haben; wir versuchen typische Felder zu extrahieren
-            # Suche rekursiv nach dicts mit sinnvollen Feldern
-            def find_conn_nodes(obj):
-                found = []
-                if isinstance(obj, dict):
-                    # Wenn dict Felder enthält, die auf Verbindung hindeuten
-                    keys = set(obj.keys())
-                    hint_keys = {"RemoteHost", "RemotePort", "Protocol", "BytesSent", "BytesReceived",
-                                 "LastActivity", "LastActive", "ConnectionID", "Id", "ID", "State"}
-                    if keys & hint_keys:
-                        found.append(obj)
-                    else:
-                        for v in obj.values():
-                            found.extend(find_conn_nodes(v))
-                elif isinstance(obj, list):
-                    for it in obj:
-                        found.extend(find_conn_nodes(it))
-                return found
-            found = find_conn_nodes(res)
-            for f in found:
-                connections.append(f)
-        else:
-            # manche Services implementieren Actions nicht sichtbar in actions-Liste; trotzdem versuchen
-            try:
-                res = svc.call_action(act)
-            except Exception:
-                continue
-            # wie oben
-            def find_conn_nodes2(obj):
-                found = []
-                if isinstance(obj, dict):
-                    keys = set(obj.keys())
-                    hint_keys = {"RemoteHost", "RemotePort", "Protocol", "BytesSent", "BytesReceived",
-                                 "LastActivity", "LastActive", "ConnectionID", "Id", "ID", "State"}
-                    if keys & hint_keys:
-                        found.append(obj)
-                    else:
-                        for v in obj.values():
-                            found.extend(find_conn_nodes2(v))
-                elif isinstance(obj, list):
-                    for it in obj:
-                        found.extend(find_conn_nodes2(it))
-                return found
-            found = find_conn_nodes2(res)
-            for f in found:
-                connections.append(f)
-
-    # Falls nichts gefunden, versuchen wir Port-Mappings (nur zur Info)
+
+    connections = []
+    for act in actions_to_try:
+        if act not in results:
+            continue
+        # res kann verschiedene Strukturen haben; wir versuchen typische Felder zu extrahieren
+        found = find_conn_nodes(results[act])
+        for f in found:
+            connections.append(f)
+
+    # Falls nichts gefunden, Port-Mappings ausgeben (nur zur Info); das Ergebnis
+    # liegt bereits aus den Probes vor, ein zweiter Call ist nicht nötig
     if not connections:
-        if "GetPortMappingNumberOfEntries" in svc.actions:
-            try:
-                n = int(svc.call_action("GetPortMappingNumberOfEntries")["NewPortMappingNumberOfEntries"])
-                print("Port-Mapping Einträge:", n)
-            except Exception:
-                pass
+        try:
+            n = int(results["GetPortMappingNumberOfEntries"]["NewPortMappingNumberOfEntries"])
+            print("Port-Mapping Einträge:", n)
+        except Exception:
+            pass
         print("Keine aktiven Verbindungen gefunden oder Service liefert keine Liste.")
         sys.exit(0)
 
-    # Dedup
-    unique = []
-    seen = set()
-    for c in connections:
-        key = tuple(sorted([(k, str(v)) for k, v in c.items()]))
-        if key in seen:
-            continue
-        seen.add(key)
-        unique.append(c)
-    connections = unique
+    # Parameternamen der Close-Actions sind pro Lauf statisch und werden einmal ermittelt;
+    # unterschiedliche Services erwarten unterschiedliche Parameternamen,
+    # ohne Parameterbeschreibung senden wir ConnectionID generisch
+    close_map = {}
+    for action, params in action_meta.items():
+        close_map[action] = next((k for k in ("ConnectionID", "ID", "Id") if k in params), "ConnectionID")
 
-    now = time.time()
-    to_kill = []
+    # Dedup, Zeitprüfung und Schließen in einem einzigen Durchlauf;
+    # die Close-Actions laufen parallel, da jede ein eigener SOAP-Roundtrip ist
+    count = 0
+    futures = {}
+    with ThreadPoolExecutor(max_workers=CLOSE_WORKERS) as ex:
+        for c, ts, age in iter_stale_connections(connections):
+            if not count:
+                print(f"Zu beendende Verbindungen (DRY_RUN={DRY_RUN}):")
+            count += 1
+            connid, remote, port = conn_identifiers(c)
+            print(f"- {remote} {port} connid={connid} last={datetime.datetime.fromtimestamp(ts)} age={age}s")
+            if not DRY_RUN:
+                futures[ex.submit(close_one, c, close_map, svc, fc)] = (connid, remote, port)
 
-    for c in connections:
-        # Versuche verschiedene Felder für Zeitpunkt
-        last = None
-        for field in ("LastActivity", "LastActive", "LastSeen", "Time", "Timestamp"):
-            if field in c:
-                last = c.get(field)
-                break
-        # Falls numeric bytes/age fields vorhanden
-        ts = parse_time_str(last)
-        # Falls kein Zeitstempel, evtl. Bytes-Transfer seit letzter Aktivität -> überspringen
-        if ts is None:
-            # Wenn State == 'CLOSED' oder ähnlich, überspringen
-            continue
-        age = now - ts
-        if age >= THRESHOLD_SECONDS:
-            to_kill.append((c, ts, int(age)))
+        for fut in as_completed(futures):
+            connid, remote, port = futures[fut]
+            ok, action, err = fut.result()
+            if ok:
+                print(f"Action {action} ausgeführt: {remote} {port} connid={connid}")
+            else:
+                print(f"Konnte Verbindung {remote} {port} connid={connid} nicht schließen: "
+                      f"keine passende Aktion oder fehlende Parameter ({err}).")
 
-    if not to_kill:
+    if not count:
         print("Keine inaktiven Verbindungen älter als Schwelle gefunden.")
-        sys.exit(0)
-
-    print(f"Zu beendende Verbindungen: {len(to_kill)} (DRY_RUN={DRY_RUN})")
-    for c, ts, age in to_kill:
-        # Bestimme Identifikatoren zum Schließen
-        connid = c.get("ConnectionID") or c.get("Id") or c.get("ID")
-        remote = c.get("RemoteHost") or c.get("Description") or ""
-        port = c.get("RemotePort") or c.get("Port") or ""
-        print(f"- {remote} {port} connid={connid} last={datetime.datetime.fromtimestamp(ts)} age={age}s")
-
-        if not DRY_RUN:
-            closed = False
-            # Mögliche Close-Actions
-            close_actions = ["DeleteConnection", "CloseConnection", "ForceCloseConnection", "DestroyConnection"]
-            for action in close_actions:
-                if action in svc.actions:
-                    try:
-                        args = {}
-                        if connid:
-                            # neue FritzConnection call_action erwartet dict mit Parametern
-                            # unterschiedliche Services erwarten unterschiedliche Parameternamen
-                            for key in ("ConnectionID", "ID", "Id"):
-                                if key in svc.actions.get(action, {}):
-                                    args[key] = connid
-                            # Wenn keine Parameterbeschreibung vorhanden, senden wir ConnectionID generisch
-                            if not args:
-                                args = {"ConnectionID": connid}
-                        else:
-                            # Fallback: RemoteHost/RemotePort falls benötigt
-                            if remote:
-                                args["RemoteHost"] = remote
-                            if port:
-                                args["RemotePort"] = port
-                        svc.call_action(action, **args)
-                        print(f"Action {action} ausgeführt.")
-                        closed = True
-                        break
-                    except Exception as e:
-                        # weiter versuchen
-                        continue
-            if not closed:
-                print("Konnte Verbindung nicht schließen: keine passende Aktion oder fehlende Parameter.")
+    else:
+        print(f"Zu beendende Verbindungen: {count}")
 
 if __name__ == "__main__":
     main()